@@ -1,23 +1,25 @@
+import collections
+import concurrent.futures
+import contextlib
 import datetime
 import os
 import tempfile
+from collections.abc import Callable, Iterable, Iterator
 from importlib.metadata import version
 from pathlib import Path
-from re import A
-from typing import Any, Literal
+from typing import Any, Literal, TypeVar
 
-import httpx
 import rich.progress
-import rich.traceback
-from datalab_api import DatalabClient, DuplicateItemError
+from datalab_api import DatalabAPIError, DatalabClient, DuplicateItemError
 from rich import print as pprint
 
 from ._api import ChemInventoryAPI
 
-rich.traceback.install(show_locals=False)
-
 __version__ = version("datalab-cheminventory-plugin")
 
+_T = TypeVar("_T")
+_R = TypeVar("_R")
+
 CUSTOM_ID_FIELD = "DataLab ID"
 """The custom field name in cheminventory that will be used to store the
 immutable datalab refcode, where necessary.
@@ -28,6 +30,36 @@ DEFAULT_LOCATION_NAME = "datalab"
 been synced from datalab to cheminventory.
 """
 
+INVENTORY_ROW_MAPPING: tuple[tuple[str, str, bool], ...] = (
+    ("barcode", "barcode", True),
+    ("Container Name", "name", False),
+    ("Container Size", "size", False),
+    ("Supplier", "supplier", False),
+    ("Substance CAS", "cas", False),
+    ("GHS H-codes", "hcodes", False),
+    ("SMILES", "smiles", False),
+    ("Unit", "unit", False),
+    ("Molecular Formula", "molecularformula", True),
+    ("Molecular Weight", "molecularweight", True),
+    ("Location", "location", False),
+    ("Date Acquired", "dateacquired", True),
+)
+"""The datalab starting material fields copied directly from a cheminventory
+inventory row, as `(datalab key, cheminventory key, whether to store empty values as None)`.
+"""
+
+DESCRIPTION_CUSTOM_FIELDS: dict[str, str] = {
+    "Identifying #": "Identifying #",
+    "Lot Number": "Lot number",
+    "Form type": "Form type",
+}
+"""Optional cheminventory custom fields that are appended to the datalab
+description, mapped to the label to use there.
+"""
+
+PROGRESS_REFRESH_PER_SECOND = 4
+"""How often progress bars are redrawn; rows can finish much faster than this."""
+
 
 class ChemInventoryDatalabSyncer:
     """A class to sync cheminventory with functionality for syncing datalab
@@ -92,15 +124,43 @@ class ChemInventoryDatalabSyncer:
     skip_files: bool = False
     """Whether to skip downloading files from cheminventory."""
 
+    max_workers: int = 8
+    """The number of concurrent requests in either sync direction: cheminventory
+    rows synced to datalab, and substance lookups and container batches exported
+    to cheminventory.
+    """
+
+    max_file_downloads: int = 8
+    """The maximum number of linked files to download concurrently for each row."""
+
+    download_chunk_size: int = 256 * 1024
+    """The chunk (and write buffer) size in bytes used when streaming linked files to disk."""
+
+    container_batch_size: int = 100
+    """The maximum number of containers to add to cheminventory in each request."""
+
     _locations: list[dict[str, Any]] | None = None
     """Cache of cheminventory locations, to avoid repeated API calls."""
 
+    _location_ids: dict[str, int] | None = None
+    """Mapping from the full names of cached cheminventory locations to their IDs."""
+
+    _custom_fields: dict[str, str] | None = None
+    """Cache of cheminventory custom field IDs, to avoid repeated API calls."""
+
+    _substance_ids: dict[tuple[str, str], int]
+    """Cache of looked-up substance IDs by `(name, cas)`, to avoid repeated API calls."""
+
+    _files_dir: tempfile.TemporaryDirectory | None = None
+    """Scratch directory for files downloaded outside of a sync, removed on `close()`."""
+
     def __init__(
         self,
         dry_run: bool = False,
         skip_files: bool = False,
         c2d_only: bool = False,
         inventory_number: int | None = None,
+        max_workers: int | None = None,
     ) -> None:
         datalab_api_url = os.getenv("DATALAB_API_URL")
         if datalab_api_url is None:
@@ -110,7 +170,12 @@ class ChemInventoryDatalabSyncer:
         self.dry_run = dry_run
         self.c2d_only = c2d_only
         self.skip_files = skip_files
+        if max_workers is not None:
+            if max_workers < 1:
+                raise ValueError(f"max_workers must be at least 1, got {max_workers}.")
+            self.max_workers = max_workers
         self._target_inventory = inventory_number
+        self._substance_ids = {}
 
         self.inventory_number, self.inventory_name = self.cheminventory.initialize(
             target_inventory=self._target_inventory
@@ -119,15 +184,33 @@ class ChemInventoryDatalabSyncer:
 
     def sync(self):
         """Perform the two-way sync from cheminventory to datalab and back."""
-        cheminventory_ids, cheminventory_deleted_ids = self.sync_to_datalab(
-            dry_run=self.dry_run, skip_files=self.skip_files
-        )
-        if not self.c2d_only:
-            self.sync_to_cheminventory(
+        # Drop anything cached by a previous sync so that changes made
+        # in cheminventory since then are picked up
+        self._locations = None
+        self._location_ids = None
+        self._custom_fields = None
+        self._substance_ids = {}
+
+        # Share one datalab client across both directions, so that its constructor's
+        # URL detection and `/info` and `/info/blocks` requests are only made once
+        with DatalabClient(self.datalab_api_url) as datalab_client:
+            # List the starting materials once for both directions; anything
+            # created or updated by the first is then skipped by the second
+            datalab_items = datalab_client.get_items(item_type="starting_materials")
+            cheminventory_ids, cheminventory_deleted_ids = self.sync_to_datalab(
                 dry_run=self.dry_run,
-                existing_ids_or_refcodes=cheminventory_ids,
-                deleted_ids_or_refcodes=cheminventory_deleted_ids,
+                skip_files=self.skip_files,
+                datalab_client=datalab_client,
+                datalab_items=datalab_items,
             )
+            if not self.c2d_only:
+                self.sync_to_cheminventory(
+                    dry_run=self.dry_run,
+                    existing_ids_or_refcodes=cheminventory_ids,
+                    deleted_ids_or_refcodes=cheminventory_deleted_ids,
+                    datalab_client=datalab_client,
+                    datalab_items=datalab_items,
+                )
 
     @property
     def cheminventory(self) -> ChemInventoryAPI:
@@ -139,11 +222,36 @@ class ChemInventoryDatalabSyncer:
             self._cheminventory = ChemInventoryAPI()
         return self._cheminventory
 
-    def get_inventory(self) -> dict:
-        return self.cheminventory.post("/inventorymanagement/export")["rows"]
+    @property
+    def files_dir(self) -> Path:
+        """The default directory for downloaded files, created on first use and
+        removed when the syncer is closed.
+
+        """
+        if self._files_dir is None:
+            self._files_dir = tempfile.TemporaryDirectory(prefix="cheminventory-files-")
+        return Path(self._files_dir.name)
+
+    def close(self) -> None:
+        """Close the cheminventory sessions and remove any downloaded files."""
+        if self._files_dir is not None:
+            self._files_dir.cleanup()
+            self._files_dir = None
+        if self._cheminventory is not None:
+            self._cheminventory.close()
 
-    def get_deleted_containers(self) -> dict:
-        return self.cheminventory.post("/inventorymanagement/deletedcontainers/get")
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def get_inventory(self) -> list[dict[str, Any]]:
+        return self.cheminventory.get_inventory()
+
+    def get_deleted_containers(self) -> list[dict[str, Any]]:
+        return self.cheminventory.get_deleted_containers()
 
     def list_linked_file_ids(
         self, substanceid: int, mimetypes: tuple[str] = ("application/pdf",)
@@ -160,23 +268,44 @@ class ChemInventoryDatalabSyncer:
         ]
 
     def download_file(self, file_id: int, dest_dir: Path | None = None) -> Path:
-        """Download a single linked file to `dest_dir` (or a fresh tmpdir) as `<file_id>.pdf`."""
+        """Download a single linked file to `dest_dir` (default: `files_dir`) as `<file_id>.pdf`."""
         if dest_dir is None:
-            dest_dir = Path(tempfile.mkdtemp())
+            dest_dir = self.files_dir
         file_url = str(self.cheminventory.post("/filestore/download", body={"fileid": file_id}))
         file_path = dest_dir / f"{file_id}.pdf"
-        with httpx.stream("GET", file_url, timeout=self.cheminventory.timeout) as response:
-            with open(file_path, "wb") as file:
-                for chunk in response.iter_bytes():
+        with self.cheminventory.download_session.stream("GET", file_url) as response:
+            response.raise_for_status()
+            with open(file_path, "wb", buffering=self.download_chunk_size) as file:
+                for chunk in response.iter_bytes(chunk_size=self.download_chunk_size):
                     file.write(chunk)
-        pprint(f"Downloaded file {file_id}.pdf to {dest_dir}")
         return file_path
 
+    def download_files(self, file_ids: list[int], dest_dir: Path | None = None) -> list[Path]:
+        """Download several linked files to `dest_dir` (created if missing, default:
+        `files_dir`) concurrently, returning the paths in the same order as `file_ids`.
+        """
+        if dest_dir is None:
+            dest_dir = self.files_dir
+        elif file_ids:
+            dest_dir.mkdir(parents=True, exist_ok=True)
+        if len(file_ids) <= 1:
+            return [self.download_file(fid, dest_dir) for fid in file_ids]
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(len(file_ids), self.max_file_downloads)
+        ) as pool:
+            return list(pool.map(lambda fid: self.download_file(fid, dest_dir), file_ids))
+
     def get_custom_fields(self) -> dict[str, str]:
         """Returns a mapping from custom field names to cheminventory custom field
         IDs (with the appropriate sf- or cf- prefix for substance or container fields,
         respectively).
+
+        The result is cached until a new custom field is created.
+
         """
+        if self._custom_fields is not None:
+            return self._custom_fields
+
         custom_fields: dict[str, str] = {}
 
         fields = self.cheminventory.post(
@@ -188,14 +317,19 @@ class ChemInventoryDatalabSyncer:
         for field in fields.get("substance", []):
             custom_fields[field["name"]] = f"sf-{field['id']}"
 
+        self._custom_fields = custom_fields
         return custom_fields
 
     def add_container_to_cheminventory(self, container: dict[str, Any]) -> None:
         """Add a container to the cheminventory."""
+        self.add_containers_to_cheminventory([container])
+
+    def add_containers_to_cheminventory(self, containers: list[dict[str, Any]]) -> None:
+        """Add several containers to the cheminventory in a single request."""
 
         self.cheminventory.post(
             "/container/add",
-            body={"data": [container]},
+            body={"data": containers},
         )
 
     def delete_container_in_cheminventory(self, container_id: int | str) -> None:
@@ -231,53 +365,68 @@ class ChemInventoryDatalabSyncer:
         container["barcode"] = entry["item_id"]
 
         if entry.get("date"):
-            container["dateacquired"] = datetime.datetime.fromisoformat(entry["date"]).strftime(
-                "%Y-%m-%d"
-            )
+            # datalab dates are ISO 8601 datetimes, so only the leading date needs parsing
+            container["dateacquired"] = datetime.date.fromisoformat(entry["date"][:10]).isoformat()
 
         container["locationid"] = location_id
         container["substanceid"] = substance_id
         return container
 
+    def map_inventory(
+        self, rows: list[dict[str, Any]], custom_fields: dict[str, str] | None = None
+    ) -> list[dict[str, Any]]:
+        """Maps all cheminventory rows to datalab starting material entries,
+        resolving the custom field keys once for the whole inventory.
+        """
+        refcode_key, description_keys = self._resolve_custom_field_keys(custom_fields)
+        return [self._map_inventory_row(row, refcode_key, description_keys) for row in rows]
+
     def map_inventory_row(
         self, row: dict[str, Any], custom_fields: dict[str, str] | None = None
     ) -> dict[str, Any]:
         """Maps a cheminventory row to a datalab starting material entry."""
-        starting_material: dict[str, str | int | None] = {}
-        starting_material["item_id"] = str(row["id"])
-        starting_material["barcode"] = row["barcode"] or None
-        starting_material["Container Name"] = row["name"]
-        starting_material["Container Size"] = row["size"]
-        starting_material["Supplier"] = row["supplier"]
-        starting_material["Substance CAS"] = row["cas"]
-        starting_material["GHS H-codes"] = row["hcodes"]
-        starting_material["SMILES"] = row["smiles"]
-        starting_material["Unit"] = row["unit"]
-        starting_material["Molecular Formula"] = row["molecularformula"] or None
-        starting_material["Molecular Weight"] = row["molecularweight"] or None
-        starting_material["Location"] = row["location"]
-        starting_material["Date Acquired"] = row["dateacquired"] or None
+        return self._map_inventory_row(row, *self._resolve_custom_field_keys(custom_fields))
+
+    @staticmethod
+    def _resolve_custom_field_keys(
+        custom_fields: dict[str, str] | None,
+    ) -> tuple[str | None, tuple[tuple[str, str], ...]]:
+        """Returns the row key of the `CUSTOM_ID_FIELD` (if defined) and the
+        `(row key, label)` pairs of any defined `DESCRIPTION_CUSTOM_FIELDS`.
+        """
+        if not custom_fields:
+            return None, ()
+        return custom_fields.get(CUSTOM_ID_FIELD), tuple(
+            (custom_fields[name], label)
+            for name, label in DESCRIPTION_CUSTOM_FIELDS.items()
+            if name in custom_fields
+        )
+
+    @staticmethod
+    def _map_inventory_row(
+        row: dict[str, Any],
+        refcode_key: str | None,
+        description_keys: tuple[tuple[str, str], ...],
+    ) -> dict[str, Any]:
+        starting_material: dict[str, str | int | None] = {"item_id": str(row["id"])}
+        starting_material.update(
+            (key, (row[source] or None) if empty_to_none else row[source])
+            for key, source, empty_to_none in INVENTORY_ROW_MAPPING
+        )
         starting_material["type"] = "starting_materials"
-        starting_material["description"] = row["comments"] if row["comments"] != "None" else ""
         starting_material["status"] = "disposed" if row["disposed"] == "1" else "available"
 
-        if custom_fields:
-            if CUSTOM_ID_FIELD in custom_fields:
-                value = row.get(custom_fields[CUSTOM_ID_FIELD])
-                if value:
-                    starting_material["refcode"] = value
-            if "Identifying #" in custom_fields:
-                value = row.get(custom_fields["Identifying #"])
-                if value:
-                    starting_material["description"] += f"\nIdentifying #: {value}"  # type: ignore
-            if "Lot Number" in custom_fields:
-                value = row.get(custom_fields["Lot Number"])
-                if value:
-                    starting_material["description"] += f"\nLot number: {value}"  # type: ignore
-            if "Form type" in custom_fields:
-                value = row.get(custom_fields["Form type"])
-                if value:
-                    starting_material["description"] += f"\nForm type: {value}"  # type: ignore
+        if refcode_key and (value := row.get(refcode_key)):
+            starting_material["refcode"] = value
+
+        comments = row.get("comments") or ""
+        if comments == "None":
+            comments = ""
+        description_parts = [comments]
+        description_parts.extend(
+            f"{label}: {value}" for key, label in description_keys if (value := row.get(key))
+        )
+        starting_material["description"] = "\n".join(description_parts)
 
         return starting_material
 
@@ -285,17 +434,23 @@ class ChemInventoryDatalabSyncer:
         """Looks up the substance ID for a given name and (optional) CAS number,
         returning the first matching ID.
 
+        Lookups are cached, as many containers typically share a substance.
+
         """
         if not cas:
             cas = "N/A"
 
+        if (name, cas) in self._substance_ids:
+            return self._substance_ids[(name, cas)]
+
         substances = self.cheminventory.post(
             "/container/getsubstance", body={"cas": cas, "name": name}
         )
         if not substances:
-            raise ValueError("No substance found with {cas=} and {name=}.")
+            raise ValueError(f"No substance found with {cas=} and {name=}.")
 
         # Get the first substance IDs
+        self._substance_ids[(name, cas)] = substances[0]["id"]
         return substances[0]["id"]
 
     def construct_locations_hierarchy(self) -> None:
@@ -309,23 +464,34 @@ class ChemInventoryDatalabSyncer:
         locations: list[dict] = self.cheminventory.post("/location/load")  # type: ignore
 
         id_to_location = {loc["id"]: loc for loc in locations}
+        # Memoise resolved names so each location's ancestry is only walked once
+        full_names: dict[int, str] = {}
 
         def _resolve_parents(loc, locations_by_id):
-            if loc.get("parent") in (None, 0):
-                return loc["name"]
+            if loc["id"] in full_names:
+                return full_names[loc["id"]]
 
-            parent = locations_by_id.get(loc["parent"])
-            if not parent:
-                raise RuntimeError(
-                    f"Location {loc['name']} has parent ID {loc['parent']} which was not found in the locations list."
-                )
+            if loc.get("parent") in (None, 0):
+                full_name = loc["name"]
+            else:
+                parent = locations_by_id.get(loc["parent"])
+                if not parent:
+                    raise RuntimeError(
+                        f"Location {loc['name']} has parent ID {loc['parent']} which was not found in the locations list."
+                    )
+                full_name = f"{_resolve_parents(parent, locations_by_id)} > {loc['name']}"
 
-            return f"{_resolve_parents(parent, locations_by_id)} > {loc['name']}"
+            full_names[loc["id"]] = full_name
+            return full_name
 
-        for ind, loc in enumerate(locations):
-            locations[ind]["full_name"] = _resolve_parents(loc, id_to_location) or loc["name"]
+        for loc in locations:
+            loc["full_name"] = _resolve_parents(loc, id_to_location) or loc["name"]
 
         self._locations = locations
+        self._location_ids = {}
+        for loc in locations:
+            # Keep the first match for any duplicated names
+            self._location_ids.setdefault(loc["full_name"], loc["id"])
 
     def get_location_id(self, name: str | None, use_default: bool = False) -> int:
         """Looks for a location with the given name in cheminventory,
@@ -342,18 +508,16 @@ class ChemInventoryDatalabSyncer:
             # Strip leading inventory name from location, since cheminventory exports locations as "Inventory > Location"
             name = ">".join(name.split(">")[1:]).strip()
 
-        if self._locations is None:
+        if self._location_ids is None:
             self.construct_locations_hierarchy()
 
-        # Find virtual location called "datalab" in list
-        for location in self._locations:  # type: ignore
-            if location["full_name"] == name:
-                return location["id"]
+        location_ids: dict[str, int] = self._location_ids  # type: ignore
+        if name in location_ids:
+            return location_ids[name]
 
-        if use_default:
-            for location in self._locations:  # type: ignore
-                if location["full_name"] == DEFAULT_LOCATION_NAME:
-                    return location["id"]
+        # Fall back to the virtual location called "datalab"
+        if use_default and DEFAULT_LOCATION_NAME in location_ids:
+            return location_ids[DEFAULT_LOCATION_NAME]
 
         raise ValueError(
             f"No location matching {name!r} or {DEFAULT_LOCATION_NAME!r} found in cheminventory."
@@ -376,18 +540,24 @@ class ChemInventoryDatalabSyncer:
                 "scope": "inventory",  # Not documented but was required to get this to work
             },
         )
+        self._custom_fields = None
 
     def sync_to_cheminventory(
         self,
         existing_ids_or_refcodes: set[str],
         deleted_ids_or_refcodes: set[str],
         dry_run: bool = True,
+        datalab_client: DatalabClient | None = None,
+        datalab_items: list[dict[str, Any]] | None = None,
     ) -> None:
         """Fetch inventory and upload to cheminventory, syncing
         only those items that have IDs that do not match the existing IDs.
 
         Parameters:
             existing_ids_or_refcodes: A set of item IDs that were already found in cheminventory.
+            datalab_client: An open datalab client to use, otherwise a new one is created.
+            datalab_items: The already-listed datalab starting materials, to avoid
+                requesting them again.
 
         """
 
@@ -398,68 +568,110 @@ class ChemInventoryDatalabSyncer:
                 self.set_custom_field(CUSTOM_ID_FIELD, "text", "container")
                 custom_fields = self.get_custom_fields()
 
-        found: int = 0
+        # Items are skipped if their ID or refcode is known to cheminventory
+        # as either an active or deleted container
+        skip_ids_or_refcodes = existing_ids_or_refcodes | deleted_ids_or_refcodes
 
         # get datalab entries
-        with DatalabClient(self.datalab_api_url) as datalab_client:
-            datalab_inventory = datalab_client.get_items(item_type="starting_materials")
-            for entry in rich.progress.track(
-                datalab_inventory, description="Exporting datalab inventory to cheminventory"
-            ):
-                if (
-                    str(entry["item_id"]) not in existing_ids_or_refcodes
-                    and entry.get("refcode") not in existing_ids_or_refcodes
-                    and str(entry["item_id"]) not in deleted_ids_or_refcodes
-                    and entry.get("refcode") not in deleted_ids_or_refcodes
-                ):
-                    found += 1
-                    # map datalab entry to cheminventory container
-                    substance_id = None
-                    location_id: int = 1
-                    if not dry_run:
-                        substance_id = self.get_substance_id(entry["name"], entry.get("CAS"))
+        with _datalab_client_context(self.datalab_api_url, datalab_client) as datalab_client:
+            if datalab_items is None:
+                datalab_items = datalab_client.get_items(item_type="starting_materials")
+            # Filter out anything already known to cheminventory up front, so
+            # that the loop below only handles genuinely new entries
+            new_entries = [
+                entry
+                for entry in datalab_items
+                if str(entry["item_id"]) not in skip_ids_or_refcodes
+                and entry.get("refcode") not in skip_ids_or_refcodes
+            ]
+            # Check the cheap skip conditions before any substance lookup
+            to_add: list[tuple[dict[str, Any], int]] = []
+            for entry in new_entries:
+                if entry["status"] == "disposed":
+                    pprint(
+                        f"Skipping {entry['name']}/{entry['item_id']} as it is marked as disposed in datalab."
+                    )
+                    continue
 
-                    try:
-                        location_id = self.get_location_id(entry.get("location"))
-                    except ValueError:
-                        pprint(
-                            f"Skipping {entry['name']}/{entry['item_id']} as location {entry.get('location')} not found in cheminventory."
-                        )
-                        found -= 1
-                        continue
+                try:
+                    location_id = self.get_location_id(entry.get("location"))
+                except ValueError:
+                    pprint(
+                        f"Skipping {entry['name']}/{entry['item_id']} as location {entry.get('location')} not found in cheminventory."
+                    )
+                    continue
+
+                to_add.append((entry, location_id))
+
+            found = len(to_add)
 
-                    if entry["status"] == "disposed":
-                        pprint(
-                            f"Skipping {entry['name']}/{entry['item_id']} as it is marked as disposed in datalab."
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                # Look up each distinct substance once, concurrently
+                substance_ids: dict[tuple[str, str | None], int | None] = {}
+                if not dry_run:
+                    substances = list(
+                        dict.fromkeys((entry["name"], entry.get("CAS")) for entry, _ in to_add)
+                    )
+                    substance_ids = dict(
+                        zip(
+                            substances,
+                            pool.map(lambda key: self.get_substance_id(*key), substances),
+                            strict=True,
                         )
-                        found -= 1
-                        continue
+                    )
 
-                    container = self.map_datalab_entry_to_cheminventory_container(
+                # map datalab entries to cheminventory containers
+                containers = [
+                    self.map_datalab_entry_to_cheminventory_container(
                         entry,
                         custom_fields=custom_fields,
                         location_id=location_id,
-                        substance_id=substance_id,
+                        substance_id=substance_ids.get((entry["name"], entry.get("CAS"))),
                     )
-                    if not dry_run:
-                        # add container to cheminventory
-                        self.add_container_to_cheminventory(container)
-                        pprint(f"Added {container['name']} to cheminventory.")
-                    else:
+                    for entry, location_id in to_add
+                ]
+
+                if not dry_run:
+                    # add containers to cheminventory, many per request
+                    batches = [
+                        containers[i : i + self.container_batch_size]
+                        for i in range(0, len(containers), self.container_batch_size)
+                    ]
+                    for batch, _ in rich.progress.track(
+                        zip(
+                            batches,
+                            pool.map(self.add_containers_to_cheminventory, batches),
+                            strict=True,
+                        ),
+                        total=len(batches),
+                        description="Exporting datalab inventory to cheminventory",
+                        refresh_per_second=PROGRESS_REFRESH_PER_SECOND,
+                    ):
+                        for container in batch:
+                            pprint(f"Added {container['name']} to cheminventory.")
+                else:
+                    for (entry, _), container in zip(to_add, containers, strict=True):
                         pprint(entry)
                         pprint(f"Would add {container['name']}/{entry['item_id']} to cheminventory")
 
         pprint(f"[green]Found {found} items to add to cheminventory.[/green]")
 
-    def get_deleted_inventory_ids(self) -> set[str]:
+    def get_deleted_inventory_ids(
+        self, deleted_containers: list[dict[str, Any]] | None = None
+    ) -> set[str]:
         """Returns the set of deleted container IDs and barcodes from cheminventory.
 
         Barcodes are included as containers synced from datalab carry the
         datalab item_id as their barcode, so this set can be checked against
         both datalab item IDs and refcodes.
 
+        Parameters:
+            deleted_containers: An already-fetched deleted containers list, to
+                avoid requesting it again.
+
         """
-        deleted_containers = self.cheminventory.post("/inventorymanagement/deletedcontainers/get")
+        if deleted_containers is None:
+            deleted_containers = self.get_deleted_containers()
         deleted_ids: set[str] = set()
         for d in deleted_containers:
             if d.get("id") is not None:
@@ -468,8 +680,164 @@ class ChemInventoryDatalabSyncer:
                 deleted_ids.add(str(d["barcode"]))
         return deleted_ids
 
+    @staticmethod
+    def _resolve_datalab_item_id(
+        entry: dict[str, Any],
+        items_by_refcode: dict[str, dict[str, Any]],
+        items_by_id: dict[str, dict[str, Any]],
+    ) -> None:
+        """Point a mapped cheminventory entry at an existing datalab starting
+        material, if one matches its refcode or barcode, by updating its `item_id`.
+        """
+        # Refcodes currently get dropped when making a new starting material,
+        # so we need to manually check if it exists already
+        # This should be an edge case, as only items originating from datalab in the first instance
+        # will have this refcode available.
+        # If the refcode exists, then set the item ID from the refcode instead.
+        if entry.get("refcode"):
+            item = items_by_refcode.get(entry["refcode"])
+            if item:
+                # Refcode suffixes are random and unrelated to the
+                # item_id, so take the real item_id from the match
+                entry["item_id"] = item["item_id"]
+
+        # In a previous life, cheminventory sync used barcodes or randomly created IDs when
+        # syncing to datalab. We need to also detect this scenario; i.e., if the item has a barcode,
+        # does it match an existing barcoded entry in datalab?
+        if entry.get("barcode") and str(entry["barcode"]) in items_by_id:
+            entry["item_id"] = entry["barcode"]
+
+    @staticmethod
+    def _resolve_collection(datalab_client: DatalabClient, collection_id: str) -> str:
+        """Returns the immutable ID of the given datalab collection, creating it if necessary."""
+        try:
+            return datalab_client.get_collection(collection_id)[0]["immutable_id"]
+        except (RuntimeError, DatalabAPIError):
+            datalab_client.create_collection(collection_id)
+            return datalab_client.get_collection(collection_id)[0]["immutable_id"]
+
+    def _sync_row_to_datalab(
+        self,
+        datalab_client: DatalabClient,
+        row: dict[str, Any],
+        entry: dict[str, Any],
+        collection_immutable_id: str | None = None,
+        dry_run: bool = True,
+        skip_files: bool = False,
+        files_dir: Path | None = None,
+        exists: bool = False,
+    ) -> tuple[str, list[str], bool]:
+        """Create or update the datalab entry for a single cheminventory row.
+
+        This is run concurrently across rows, so rather than printing directly
+        it returns the outcome (one of `"created"`, `"updated"`, `"deleted"`,
+        `"failed"` or `"found"` for a dry run), the messages to print, and
+        whether attaching the row's linked files to the entry failed.
+
+        Parameters:
+            collection_immutable_id: The immutable ID of an existing collection
+                to add newly created items to.
+            files_dir: A directory to download linked files into, under a
+                subdirectory per container.
+            exists: Whether the entry is already known to exist in datalab, in
+                which case it is updated without first attempting to create it.
+
+        """
+        messages: list[str] = []
+        item_id = entry["item_id"]
+        label = f"{item_id}\t{entry.get('barcode')}"
+
+        if dry_run:
+            messages.append(f"[yellow]·\t{label}[/yellow]")
+            return "found", messages, False
+
+        existing_fnames = set()
+        try:
+            created = False
+            if not exists:
+                try:
+                    item_data = entry
+                    if collection_immutable_id is not None:
+                        item_data = entry | {
+                            "collections": [{"immutable_id": collection_immutable_id}]
+                        }
+                    datalab_client.create_item(item_id, entry["type"], item_data)
+                    created = True
+                except DuplicateItemError:
+                    # e.g., created in datalab since the existing items were indexed
+                    pass
+
+            if created:
+                outcome = "created"
+                messages.append(f"[green]✓\t{label}[/green]")
+            else:
+                # If the item already exists, pull it and see if it needs to be updated
+                existing_item = datalab_client.get_item(item_id)
+                if existing_item["type"] != entry["type"]:
+                    raise ValueError(
+                        f"Item {item_id} already exists with type {existing_item['type']}, but we are trying to create it with type {entry['type']}."
+                    )
+
+                # datalab disposal wins over an active cheminventory container:
+                # delete the container (still restorable from the deleted
+                # containers list) rather than reverting the datalab status
+                if existing_item.get("status") == "disposed" and entry["status"] != "disposed":
+                    self.delete_container_in_cheminventory(row["id"])
+                    messages.append(
+                        f"[green]✓\tDeleted container {row['id']} in cheminventory as {item_id} is disposed in datalab.[/green]"
+                    )
+                    return "deleted", messages, False
+
+                response = datalab_client.update_item(
+                    item_id,
+                    entry,
+                )
+                if response["status"] != "success":
+                    raise RuntimeError(f"Failed to update item: {response['message']}")
+
+                outcome = "updated"
+                existing_fnames = {f["original_name"] for f in existing_item["files"]}
+                messages.append(f"[yellow]·\t{label}[/yellow]")
+
+        except Exception as e:
+            messages.append(f"[red]✗\t{label}:\n{e}[/red]")
+            return "failed", messages, False
+
+        # The entry itself has been created or updated by this point, so a
+        # failure below is reported against its files rather than the entry
+        try:
+            # Only list the linked files once the item is known to need them, and
+            # only download those that are not already attached in datalab
+            file_ids: list[int] = []
+            if not skip_files and row.get("substanceid") is not None:
+                file_ids = self.list_linked_file_ids(row["substanceid"])
+            ids_to_download = [fid for fid in file_ids if f"{fid}.pdf" not in existing_fnames]
+            # Rows are synced concurrently and may share linked files, so each
+            # container downloads into its own subdirectory
+            dest_dir = files_dir / str(row["id"]) if files_dir is not None else None
+            for f in self.download_files(ids_to_download, dest_dir=dest_dir):
+                messages.append(f"Downloaded file {f.name} to {f.parent}")
+                file_resp = datalab_client.upload_file(item_id, f)
+                datalab_client.create_data_block(
+                    item_id=item_id,
+                    block_type="media",
+                    file_ids=file_resp["file_id"],
+                )
+                messages.append(f"[green]✓\tAdded file to {label}[/green]")
+
+        except Exception as e:
+            messages.append(f"[red]✗\tFailed to attach files to {label}:\n{e}[/red]")
+            return outcome, messages, True
+
+        return outcome, messages, False
+
     def sync_to_datalab(
-        self, collection_id: str | None = None, dry_run: bool = True, skip_files: bool = False
+        self,
+        collection_id: str | None = None,
+        dry_run: bool = True,
+        skip_files: bool = False,
+        datalab_client: DatalabClient | None = None,
+        datalab_items: list[dict[str, Any]] | None = None,
     ) -> tuple[set[str], set[str]]:
         """Fetch inventory and upload to datalab, updating items that already exist.
 
@@ -477,6 +845,9 @@ class ChemInventoryDatalabSyncer:
             collection_id: Put the synced items into the given collection.
             dry_run: Whether to actually update datalab entries.
             skip_files: Whether to skip downloading files from cheminventory.
+            datalab_client: An open datalab client to use, otherwise a new one is created.
+            datalab_items: The already-listed datalab starting materials, to avoid
+                requesting them again.
 
         Returns:
             A set of item IDs that were found in cheminventory.
@@ -487,128 +858,104 @@ class ChemInventoryDatalabSyncer:
 
         ids_found = set()
 
-        with DatalabClient(self.datalab_api_url) as datalab_client:
+        with _datalab_client_context(self.datalab_api_url, datalab_client) as datalab_client:
             successes = 0
             failures = 0
+            file_failures = 0
             updated = 0
             deleted = 0
             total = 0
 
             custom_fields = self.get_custom_fields()
 
-            ids_deleted = self.get_deleted_inventory_ids()
+            deleted_containers = self.get_deleted_containers()
+            ids_deleted = self.get_deleted_inventory_ids(deleted_containers)
 
             inventory = self.get_inventory()
-            for row in rich.progress.track(inventory, description="Importing cheminventory"):
-                entry = self.map_inventory_row(row, custom_fields=custom_fields)
-                file_ids: list[int] = []
-                if not dry_run and not skip_files:
-                    file_ids = self.list_linked_file_ids(row["substanceid"])
-
+            # Index the existing starting materials once, rather than looking
+            # up each row's refcode and barcode individually
+            if datalab_items is None:
+                datalab_items = datalab_client.get_items(item_type="starting_materials")
+            items_by_refcode = {
+                item["refcode"]: item for item in datalab_items if item.get("refcode")
+            }
+            items_by_id = {str(item["item_id"]): item for item in datalab_items}
+
+            entries = self.map_inventory(inventory, custom_fields=custom_fields)
+            for entry in entries:
                 # Accumulate cheminventory container IDs to avoid duplication
                 ids_found.add(str(entry["item_id"]))
-
-                # Refcodes currently get dropped when making a new starting material,
-                # so we need to manually check if it exists already
-                # This should be an edge case, as only items originating from datalab in the first instance
-                # will have this refcode available.
-                # If the refcode exists, then set the item ID from the refcode instead.
                 if entry.get("refcode"):
                     ids_found.add(str(entry["refcode"]))
-                    try:
-                        item = datalab_client.get_item(refcode=entry["refcode"])
-                        if item:
-                            # Refcode suffixes are random and unrelated to the
-                            # item_id, so take the real item_id from the match
-                            entry["item_id"] = item["item_id"]
-                    except Exception:
-                        pass
-
-                # In a previous life, cheminventory sync used barcodes or randomly created IDs when
-                # syncing to datalab. We need to also detect this scenario; i.e., if the item has a barcode,
-                # does it match an existing barcoded entry in datalab?
                 if entry.get("barcode"):
                     ids_found.add(str(entry["barcode"]))
-                    try:
-                        item = datalab_client.get_item(item_id=entry["barcode"])
-                        if item:
-                            entry["item_id"] = entry["barcode"]
-                    except Exception:
-                        pass
-
-                existing_fnames = set()
-                total += 1
-                if dry_run:
-                    pprint(f"[yellow]·\t{entry.get('item_id')}\t{entry.get('barcode')}[/yellow]")
-                else:
-                    try:
-                        try:
-                            datalab_client.create_item(
-                                entry["item_id"],
-                                entry["type"],
-                                entry,
-                                collection_id=collection_id,
-                            )
 
+                self._resolve_datalab_item_id(entry, items_by_refcode, items_by_id)
+
+            # Resolve (or create) the collection once, rather than in every
+            # concurrent `create_item` call where new collections would race
+            collection_immutable_id = None
+            if collection_id is not None and not dry_run:
+                collection_immutable_id = self._resolve_collection(datalab_client, collection_id)
+
+            # Rows that resolve to the same datalab item are synced one after
+            # another, so that they never create or attach files to it concurrently
+            rows_by_item_id: dict[str, list[tuple[dict[str, Any], dict[str, Any]]]] = {}
+            for row, entry in zip(inventory, entries, strict=True):
+                rows_by_item_id.setdefault(str(entry["item_id"]), []).append((row, entry))
+
+            # Each row is dominated by network round-trips to datalab and
+            # cheminventory, so items are processed concurrently; results are
+            # yielded in the order each item first appears in the inventory (with
+            # all of its rows together) so the output stays deterministic.
+            # Downloaded files are only needed until they are uploaded to datalab.
+            with (
+                tempfile.TemporaryDirectory(prefix="cheminventory-files-") as tmpdir,
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool,
+                rich.progress.Progress(refresh_per_second=PROGRESS_REFRESH_PER_SECOND) as progress,
+            ):
+                task = progress.add_task("Importing cheminventory", total=len(entries))
+
+                def _sync_rows(rows):
+                    return [
+                        self._sync_row_to_datalab(
+                            datalab_client,
+                            row,
+                            entry,
+                            collection_immutable_id=collection_immutable_id,
+                            dry_run=dry_run,
+                            skip_files=skip_files,
+                            files_dir=Path(tmpdir),
+                            exists=entry["item_id"] in items_by_id,
+                        )
+                        for row, entry in rows
+                    ]
+
+                for results in _bounded_map(
+                    pool,
+                    _sync_rows,
+                    rows_by_item_id.values(),
+                    buffersize=2 * self.max_workers,
+                ):
+                    for outcome, messages, files_failed in results:
+                        total += 1
+                        progress.advance(task)
+                        # Print each row's messages in one go above the progress bar
+                        if messages:
+                            progress.console.print("\n".join(messages))
+                        if outcome == "created":
                             successes += 1
-                            pprint(
-                                f"[green]✓\t{entry.get('item_id')}\t{entry.get('barcode')}[/green]"
-                            )
-                        except DuplicateItemError:
-                            # If the item already exists, pull it and see if it needs to be updated
-                            existing_item = datalab_client.get_item(entry["item_id"])
-                            if existing_item["type"] != entry["type"]:
-                                raise ValueError(
-                                    f"Item {entry['item_id']} already exists with type {existing_item['type']}, but we are trying to create it with type {entry['type']}."
-                                )
-
-                            # datalab disposal wins over an active cheminventory container:
-                            # delete the container (still restorable from the deleted
-                            # containers list) rather than reverting the datalab status
-                            if (
-                                existing_item.get("status") == "disposed"
-                                and entry["status"] != "disposed"
-                            ):
-                                self.delete_container_in_cheminventory(row["id"])
-                                deleted += 1
-                                pprint(
-                                    f"[green]✓\tDeleted container {row['id']} in cheminventory as {entry['item_id']} is disposed in datalab.[/green]"
-                                )
-                                continue
-
-                            response = datalab_client.update_item(
-                                entry["item_id"],
-                                entry,
-                            )
-                            if response["status"] != "success":
-                                raise RuntimeError(f"Failed to update item: {response['message']}")
-
+                        elif outcome == "updated":
                             updated += 1
-                            existing_fnames = {f["original_name"] for f in existing_item["files"]}
-                            pprint(
-                                f"[yellow]·\t{entry.get('item_id')}\t{entry.get('barcode')}[/yellow]"
-                            )
+                        elif outcome == "deleted":
+                            deleted += 1
+                        elif outcome == "failed":
+                            failures += 1
+                        if files_failed:
+                            file_failures += 1
 
-                        ids_to_download = [
-                            fid for fid in file_ids if f"{fid}.pdf" not in existing_fnames
-                        ]
-                        for fid in ids_to_download:
-                            f = self.download_file(fid)
-                            file_resp = datalab_client.upload_file(entry["item_id"], f)
-                            datalab_client.create_data_block(
-                                item_id=entry["item_id"],
-                                block_type="media",
-                                file_ids=file_resp["file_id"],
-                            )
-                            pprint(
-                                f"[green]✓\tAdded file to {entry.get('item_id')}\t{entry.get('barcode')}[/green]"
-                            )
-
-                    except Exception as e:
-                        failures += 1
-                        pprint(
-                            f"[red]✗\t{entry.get('item_id')}\t{entry.get('barcode')}:\n{e}[/red]"
-                        )
+            # All files have been fetched by this point
+            self.cheminventory.close_downloads()
 
             if not dry_run:
                 pprint(f"\n[green]Created {successes} items.[/green]")
@@ -620,37 +967,33 @@ class ChemInventoryDatalabSyncer:
                     )
                 if failures > 0:
                     pprint(f"[red]Failed to create {failures} items.[/red]")
+                if file_failures > 0:
+                    pprint(f"[red]Failed to attach files to {file_failures} items.[/red]")
 
             if dry_run:
                 pprint(f"\n[green]Found {total} items.[/green]")
 
             for row in rich.progress.track(
-                self.get_deleted_containers(), description="Checking deleted containers"
+                deleted_containers,
+                description="Checking deleted containers",
+                refresh_per_second=PROGRESS_REFRESH_PER_SECOND,
             ):
-                # If the item already exists, pull it and see if it needs to be updated -- need to check both ID and barcode as before
+                # Look the item up by barcode, then by container ID, in the index of
+                # starting materials fetched above rather than querying datalab for each
                 container_id = row.get("id")
                 barcode = row.get("barcode")
-                existing_item = None
                 found_id = None
-                try:
-                    existing_item = datalab_client.get_item(barcode)
-                    found_id = barcode
-                except Exception:
-                    pass
-
-                if not existing_item:
-                    try:
-                        existing_item = datalab_client.get_item(container_id)
-                        found_id = container_id
-                    except Exception:
-                        pass
+                if barcode and str(barcode) in items_by_id:
+                    found_id = str(barcode)
+                elif container_id is not None and str(container_id) in items_by_id:
+                    found_id = str(container_id)
 
-                if existing_item and found_id:
+                if found_id:
                     item_data = {"status": "disposed"}
 
                     if not dry_run:
                         try:
-                            response = datalab_client.update_item(
+                            datalab_client.update_item(
                                 found_id,
                                 item_data,
                             )
@@ -670,47 +1013,80 @@ class ChemInventoryDatalabSyncer:
         return ids_found, ids_deleted
 
 
+def _bounded_map(
+    pool: concurrent.futures.Executor,
+    fn: Callable[[_T], _R],
+    iterable: Iterable[_T],
+    buffersize: int,
+) -> Iterator[_R]:
+    """Like `pool.map(fn, iterable)`, yielding results in order, but only keeping
+    `buffersize` calls in flight rather than submitting every call up front.
+    """
+    pending: collections.deque[concurrent.futures.Future[_R]] = collections.deque()
+    try:
+        for arg in iterable:
+            if len(pending) >= buffersize:
+                yield pending.popleft().result()
+            pending.append(pool.submit(fn, arg))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _datalab_client_context(
+    datalab_api_url: str, datalab_client: DatalabClient | None = None
+) -> contextlib.AbstractContextManager[DatalabClient]:
+    """Returns a context for a new datalab client, or one that leaves the
+    provided (already opened) client open on exit.
+    """
+    if datalab_client is None:
+        return DatalabClient(datalab_api_url)
+    return contextlib.nullcontext(datalab_client)
+
+
 def _status(inventory_number: int | None = None) -> None:
     """Print a summary of the connected cheminventory without contacting datalab."""
-    api = ChemInventoryAPI()
-    active, others = api.list_inventories()
-    pprint(f"[green]Default inventory:[/green] {active[1]} ({active[0]})")
-    if others:
-        pprint(f"[green]Other accessible inventories ({len(others)}):[/green]")
-        for inv_id, inv_name in others:
-            pprint(f"    {inv_name} ({inv_id})")
-
-    resolved_id, resolved_name = api.initialize(target_inventory=inventory_number)
-    pprint(f"\n[green]Querying:[/green] {resolved_name} ({resolved_id})")
-
-    if inventory_number is not None and others:
-        pprint(
-            "[bold yellow]WARNING:[/bold yellow] this API key has access to multiple "
-            f"inventories and the active one is now {resolved_name} ({resolved_id}) "
-            "account-wide. Any concurrent client sharing this API key may flip the "
-            "active inventory and cause cross-inventory data leakage. Ensure only one "
-            "process uses this key at a time, or request per-inventory API keys."
-        )
+    with ChemInventoryAPI() as api:
+        active, others = api.list_inventories()
+        pprint(f"[green]Default inventory:[/green] {active[1]} ({active[0]})")
+        if others:
+            pprint(f"[green]Other accessible inventories ({len(others)}):[/green]")
+            for inv_id, inv_name in others:
+                pprint(f"    {inv_name} ({inv_id})")
+
+        resolved_id, resolved_name = api.initialize(target_inventory=inventory_number)
+        pprint(f"\n[green]Querying:[/green] {resolved_name} ({resolved_id})")
+
+        if inventory_number is not None and others:
+            pprint(
+                "[bold yellow]WARNING:[/bold yellow] this API key has access to multiple "
+                f"inventories and the active one is now {resolved_name} ({resolved_id}) "
+                "account-wide. Any concurrent client sharing this API key may flip the "
+                "active inventory and cause cross-inventory data leakage. Ensure only one "
+                "process uses this key at a time, or request per-inventory API keys."
+            )
 
-    inventory = api.post("/inventorymanagement/export")["rows"]
-    deleted = api.post("/inventorymanagement/deletedcontainers/get")
+        inventory = api.get_inventory()
+        deleted = api.get_deleted_containers()
 
-    active_rows = [row for row in inventory if str(row.get("disposed", "0")) != "1"]
-    disposed = [row for row in inventory if str(row.get("disposed", "0")) == "1"]
+        active_rows = [row for row in inventory if str(row.get("disposed", "0")) != "1"]
+        disposed = [row for row in inventory if str(row.get("disposed", "0")) == "1"]
 
-    locations: dict[str, int] = {}
-    for row in active_rows:
-        loc = row.get("location") or "(no location)"
-        locations[loc] = locations.get(loc, 0) + 1
+        locations: dict[str, int] = {}
+        for row in active_rows:
+            loc = row.get("location") or "(no location)"
+            locations[loc] = locations.get(loc, 0) + 1
 
-    pprint(
-        f"[green]Containers:[/green] {len(inventory)} total, "
-        f"{len(active_rows)} active, {len(disposed)} disposed"
-    )
-    pprint(f"[green]Deleted containers:[/green] {len(deleted)}")
-    pprint(f"[green]Active locations:[/green] {len(locations)}")
-    for loc, count in sorted(locations.items(), key=lambda kv: -kv[1])[:10]:
-        pprint(f"  {count:>5}  {loc}")
+        pprint(
+            f"[green]Containers:[/green] {len(inventory)} total, "
+            f"{len(active_rows)} active, {len(disposed)} disposed"
+        )
+        pprint(f"[green]Deleted containers:[/green] {len(deleted)}")
+        pprint(f"[green]Active locations:[/green] {len(locations)}")
+        for loc, count in sorted(locations.items(), key=lambda kv: -kv[1])[:10]:
+            pprint(f"  {count:>5}  {loc}")
 
 
 def _main():
@@ -740,12 +1116,25 @@ def _main():
             action="store_true",
             help="Only sync from cheminventory to datalab.",
         )
+        p.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help=f"Number of rows, substance lookups or container batches to sync concurrently (default: {ChemInventoryDatalabSyncer.max_workers}).",
+        )
 
     status_parser = subparsers.add_parser(
         "status",
         help="Print a summary of the connected cheminventory (no datalab connection required).",
     )
 
+    for p in (parser, sync_parser, status_parser):
+        p.add_argument(
+            "--debug",
+            action="store_true",
+            help="Show local variables in tracebacks.",
+        )
+
     env_inventory = os.getenv("CHEMINVENTORY_INVENTORY_ID")
     env_inventory_default = int(env_inventory) if env_inventory else None
     for p in (parser, sync_parser, status_parser):
@@ -760,17 +1149,24 @@ def _main():
 
     args = parser.parse_args()
 
+    # Only install the rich traceback handler for the CLI, so that importing
+    # the package as a library does not patch `sys.excepthook`
+    import rich.traceback
+
+    rich.traceback.install(show_locals=args.debug)
+
     if args.command == "status":
         _status(inventory_number=args.inventory)
         return
 
-    syncer = ChemInventoryDatalabSyncer(
+    with ChemInventoryDatalabSyncer(
         dry_run=args.dry_run,
         skip_files=args.skip_files,
         c2d_only=args.c2d_only,
         inventory_number=args.inventory,
-    )
-    syncer.sync()
+        max_workers=args.workers,
+    ) as syncer:
+        syncer.sync()
 
 
 if __name__ == "__main__":
@@ -1,11 +1,44 @@
+import importlib.util
 import os
+import threading
+import time
 from importlib.metadata import version
-from typing import Any
+from typing import Any, cast
 
 import httpx
 
 CHEMINVENTORY_API_URL = os.getenv("CHEMINVENTORY_API_URL", "https://app.cheminventory.net/api")
 
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+"""Whether the optional `h2` package (e.g., from `httpx[http2]`) is installed, in which
+case API requests are multiplexed over a single HTTP/2 connection.
+"""
+
+RETRY_STATUS_CODES = frozenset({429, 502, 503, 504})
+"""HTTP status codes that indicate a transient failure worth retrying."""
+
+RETRY_EXCEPTIONS = (
+    httpx.ReadTimeout,
+    httpx.WriteTimeout,
+    httpx.PoolTimeout,
+    httpx.ReadError,
+    httpx.RemoteProtocolError,
+)
+"""Transient errors raised once a connection is established, which are worth retrying.
+Connection failures are instead retried by the sessions' transports, and other errors
+(e.g., an unsupported URL scheme) would only fail again.
+"""
+
+POOL_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=100)
+"""Connection pool limits for both sessions; rows and files are fetched concurrently
+during a sync, so enough idle connections are kept alive to avoid re-handshaking.
+"""
+
+NON_IDEMPOTENT_ENDPOINTS = frozenset({"/container/add", "/customfields/save"})
+"""Endpoints that create new records, which are never retried after a request may
+have reached the server (connection failures are still retried by the transports).
+"""
+
 
 class ChemInventoryAPI:
     """A wrapper for the cheminventory API that performs
@@ -13,17 +46,42 @@ class ChemInventoryAPI:
     """
 
     timeout: httpx.Timeout = httpx.Timeout(60.0, read=180.0)
+    max_retries: int = 3
+    """The number of times to retry a request that failed transiently: either by
+    the transport, for connection failures, or otherwise with exponential backoff.
+    """
+    retry_backoff: float = 1.0
+    """The delay in seconds before the first retry, doubling for each further retry."""
     user_agent = f"datalab-cheminventory-plugin/{version('datalab-cheminventory-plugin')}"
     _session: httpx.Client | None = None
-    inventory_number: int | None = None
+    _download_session: httpx.Client | None = None
+    _inventory_number: int | None = None
 
     def __init__(self, inventory_number: int | None = None):
         self.api_url = CHEMINVENTORY_API_URL
         self.auth_token = os.getenv("CHEMINVENTORY_API_KEY")
         if self.auth_token is None:
             raise ValueError("CHEMINVENTORY_API_KEY environment variable not set.")
+        # Sessions are created lazily, possibly from several worker threads at once
+        self._session_lock = threading.Lock()
+        self.headers = {
+            "Content-Type": "application/json",
+            "User-Agent": self.user_agent,
+        }
         self.inventory_number = inventory_number
 
+    @property
+    def inventory_number(self) -> int | None:
+        return self._inventory_number
+
+    @inventory_number.setter
+    def inventory_number(self, inventory_number: int | None) -> None:
+        # The auth body is sent with every request, so only rebuild it when it changes
+        self._inventory_number = inventory_number
+        self.auth_body: dict[str, Any] = {"authtoken": self.auth_token}
+        if inventory_number is not None:
+            self.auth_body["inventory"] = inventory_number
+
     def initialize(self, target_inventory: int | None = None) -> tuple[int, str]:
         """Initialises the API connection.
 
@@ -105,33 +163,81 @@ class ChemInventoryAPI:
     @property
     def session(self) -> httpx.Client:
         if self._session is None:
-            self._session = httpx.Client(timeout=self.timeout)
+            with self._session_lock:
+                if self._session is None:
+                    # All API calls go to a single host, so with HTTP/2 the concurrent
+                    # requests made during a sync can share one connection
+                    self._session = httpx.Client(
+                        timeout=self.timeout,
+                        headers=self.headers,
+                        transport=httpx.HTTPTransport(
+                            retries=self.max_retries, http2=HTTP2_AVAILABLE, limits=POOL_LIMITS
+                        ),
+                    )
         return self._session
 
-    def __del__(self):
-        if self._session is not None:
-            self._session.close()
-
     @property
-    def auth_body(self):
-        body = {"authtoken": self.auth_token}
-        if self.inventory_number is not None:
-            body["inventory"] = self.inventory_number
-        return body
+    def download_session(self) -> httpx.Client:
+        """A separate persistent client for fetching files from the pre-signed
+        URLs returned by `/filestore/download`, which live on a different host
+        to the API and should not be sent the API headers.
 
-    @property
-    def headers(self):
-        return {
-            "Content-Type": "application/json",
-            "User-Agent": self.user_agent,
-        }
+        """
+        if self._download_session is None:
+            with self._session_lock:
+                if self._download_session is None:
+                    self._download_session = httpx.Client(
+                        timeout=self.timeout,
+                        transport=httpx.HTTPTransport(retries=self.max_retries, limits=POOL_LIMITS),
+                    )
+        return self._download_session
+
+    def close_downloads(self) -> None:
+        """Close the file download session, e.g., once a sync has finished."""
+        with self._session_lock:
+            if self._download_session is not None:
+                self._download_session.close()
+                self._download_session = None
+
+    def close(self) -> None:
+        """Close any open HTTP sessions."""
+        with self._session_lock:
+            for attr in ("_session", "_download_session"):
+                session = getattr(self, attr)
+                if session is not None:
+                    session.close()
+                    setattr(self, attr, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
 
     def _post(self, endpoint: str, body: dict[str, Any] | None = None) -> httpx.Response:
-        """Make a POST request to the cheminventory API, returning the raw response."""
-        if body is None:
-            body = {}
-        url = f"{self.api_url.rstrip('/')}/{endpoint.lstrip('/')}"
-        response = self.session.post(url, json=self.auth_body | body, headers=self.headers)
+        """Make a POST request to the cheminventory API, returning the raw response.
+
+        `RETRY_EXCEPTIONS` and `RETRY_STATUS_CODES` responses are retried with
+        exponential backoff, unless the endpoint is in `NON_IDEMPOTENT_ENDPOINTS`;
+        connection failures have already been retried by the session's transport.
+
+        """
+        payload = self.auth_body | body if body else self.auth_body
+        endpoint = f"/{endpoint.lstrip('/')}"
+        url = f"{self.api_url.rstrip('/')}{endpoint}"
+        attempts = 1 if endpoint in NON_IDEMPOTENT_ENDPOINTS else self.max_retries + 1
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.post(url, json=payload)
+            except RETRY_EXCEPTIONS:
+                if attempt == attempts - 1:
+                    raise
+                continue
+            if response.status_code not in RETRY_STATUS_CODES:
+                break
         return response
 
     def post(
@@ -153,13 +259,13 @@ class ChemInventoryAPI:
         response = self._post(endpoint, body)
         if response.status_code != 200:
             raise RuntimeError(
-                f"Bad response from cheminventory ({response.status_code=}): {response.content}"
+                f"Bad response from cheminventory ({response.status_code=}): {response.text}"
             )
 
         try:
             json_resp = response.json()
         except Exception:
-            raise RuntimeError(f"Bad response from cheminventory: {response.content}")
+            raise RuntimeError(f"Bad response from cheminventory: {response.text}")
 
         if json_resp["status"] != "success":
             raise RuntimeError(f"Error reported by cheminventory: {json_resp}")
@@ -168,3 +274,11 @@ class ChemInventoryAPI:
             raise RuntimeError(f"Response does not contain {results_key} key: {json_resp}")
 
         return json_resp[results_key]
+
+    def get_inventory(self) -> list[dict[str, Any]]:
+        """Returns all container rows from the inventory export."""
+        return self.post("/inventorymanagement/export")["rows"]
+
+    def get_deleted_containers(self) -> list[dict[str, Any]]:
+        """Returns the deleted containers list."""
+        return cast(list[dict[str, Any]], self.post("/inventorymanagement/deletedcontainers/get"))
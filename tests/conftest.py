@@ -1,5 +1,6 @@
 import copy
 import json
+from pathlib import Path
 
 import respx
 from datalab_api import DuplicateItemError
@@ -134,8 +135,13 @@ class FakeDatalab:
     def __init__(self):
         self.items: dict[str, dict] = {}
         self._refcode_counter = 0
+        self.clients_opened = 0
+        self.create_attempts = 0
+        self.items_listed = 0
+        self.collections: dict[str, dict] = {}
 
     def __call__(self, api_url, *args, **kwargs):
+        self.clients_opened += 1
         return self
 
     def __enter__(self):
@@ -165,6 +171,7 @@ class FakeDatalab:
         return item
 
     def get_items(self, item_type="samples"):
+        self.items_listed += 1
         return [copy.deepcopy(i) for i in self.items.values() if i["type"] == item_type]
 
     def get_item(self, item_id=None, refcode=None, load_blocks=False):
@@ -181,6 +188,7 @@ class FakeDatalab:
         return copy.deepcopy(item)
 
     def create_item(self, item_id=None, item_type="samples", item_data=None, collection_id=None):
+        self.create_attempts += 1
         if str(item_id) in self.items:
             raise DuplicateItemError(f"Item {item_id=} already exists.")
         item = dict(item_data or {})
@@ -191,6 +199,33 @@ class FakeDatalab:
         self.items[str(item_id)] = item
         return copy.deepcopy(item)
 
+    def get_collection(self, collection_id):
+        collection = self.collections.get(collection_id)
+        if collection is None:
+            raise RuntimeError(f"Failed to find collection {collection_id=}.")
+        return copy.deepcopy(collection), []
+
+    def create_collection(self, collection_id, collection_data=None):
+        # datalab only returns the expected 201 for the first request
+        if collection_id in self.collections:
+            raise RuntimeError(f"Collection {collection_id=} already exists.")
+        self.collections[collection_id] = {
+            "collection_id": collection_id,
+            "immutable_id": f"collection-{len(self.collections)}",
+        }
+        return copy.deepcopy(self.collections[collection_id])
+
+    def upload_file(self, item_id, file_path):
+        item = self.items[str(item_id)]
+        file_id = f"file-{len(item['files'])}"
+        item["files"].append({"immutable_id": file_id, "original_name": Path(file_path).name})
+        return {"status": "success", "file_id": file_id}
+
+    def create_data_block(self, item_id=None, block_type=None, file_ids=None):
+        item = self.items[str(item_id)]
+        item.setdefault("blocks", []).append({"blocktype": block_type, "file_id": file_ids})
+        return {"status": "success"}
+
     def update_item(self, item_id, item_data):
         item = self.items.get(str(item_id))
         if item is None:
@@ -215,6 +250,10 @@ class FakeChemInventory:
         self.container_fields: list[dict] = []
         self.substance_fields: list[dict] = []
         self.added_containers: list[dict] = []
+        self.linked_files: dict[int, list[dict]] = {}
+        self.downloaded_files: list[int] = []
+        self.missing_files: set[int] = set()
+        self.router: respx.MockRouter | None = None
         self._next_row_id = 1000
         self._next_field_id = 1
 
@@ -274,6 +313,11 @@ class FakeChemInventory:
         )
         return row
 
+    def calls_to(self, endpoint: str) -> int:
+        """Return the number of requests made to the given endpoint path."""
+        assert self.router is not None
+        return sum(call.request.url.path == endpoint for call in self.router.calls)
+
     def custom_field_key(self, name: str) -> str | None:
         """Return the cf-/sf- prefixed key for a custom field name, if defined."""
         for field in self.container_fields:
@@ -303,6 +347,7 @@ def fake_cheminventory(example_locations, mock_environ, cheminventory_api_url):
     fake = FakeChemInventory(example_locations)
 
     with respx.mock(base_url=cheminventory_api_url, assert_all_called=False) as respx_mock:
+        fake.router = respx_mock
         respx_mock.post("/general/getdetails").mock(
             side_effect=lambda request: _success(
                 {
@@ -387,7 +432,25 @@ def fake_cheminventory(example_locations, mock_environ, cheminventory_api_url):
         respx_mock.post("/container/getsubstance").mock(
             side_effect=lambda request: _success([{"id": 9001}])
         )
-        respx_mock.post("/filestore/getlinkedfiles").mock(side_effect=lambda request: _success([]))
+        respx_mock.post("/filestore/getlinkedfiles").mock(
+            side_effect=lambda request: _success(
+                fake.linked_files.get(json.loads(request.content)["substanceid"], [])
+            )
+        )
+        respx_mock.post("/filestore/download").mock(
+            side_effect=lambda request: _success(
+                f"{cheminventory_api_url}/files/{json.loads(request.content)['fileid']}"
+            )
+        )
+
+        def _download_file(request):
+            file_id = int(request.url.path.rsplit("/", 1)[-1])
+            if file_id in fake.missing_files:
+                return Response(404, text="NoSuchKey")
+            fake.downloaded_files.append(file_id)
+            return Response(200, content=b"%PDF-1.4 " + str(file_id).encode())
+
+        respx_mock.get(path__regex=r"^/files/\d+$").mock(side_effect=_download_file)
 
         yield fake
 
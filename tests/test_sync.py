@@ -113,6 +113,7 @@ def test_item_disposed_in_datalab_is_not_synced_to_cheminventory(
 
     assert fake_cheminventory.added_containers == []
     assert fake_cheminventory.rows == []
+    assert fake_cheminventory.calls_to("/container/getsubstance") == 0
 
 
 def test_datalab_native_item_synced_to_cheminventory_once(syncer, fake_cheminventory, fake_datalab):
@@ -265,3 +266,174 @@ def test_datalab_native_item_deleted_in_cheminventory_is_disposed(
     syncer.sync()
     assert len(fake_cheminventory.added_containers) == 1
     assert fake_cheminventory.rows == []
+
+
+def test_linked_files_are_uploaded_once(fake_cheminventory, fake_datalab):
+    from datalab_cheminventory_plugin import ChemInventoryDatalabSyncer
+
+    fake_cheminventory.add_row(id=101, name="Lithium foil", substanceid=9001)
+    fake_cheminventory.linked_files[9001] = [
+        {"id": 11, "mimetype": "application/pdf"},
+        {"id": 12, "mimetype": "application/pdf"},
+        {"id": 13, "mimetype": "image/png"},
+    ]
+    syncer = ChemInventoryDatalabSyncer()
+
+    syncer.sync()
+
+    item = fake_datalab.items["101"]
+    assert sorted(f["original_name"] for f in item["files"]) == ["11.pdf", "12.pdf"]
+    assert len(item["blocks"]) == 2
+    assert sorted(fake_cheminventory.downloaded_files) == [11, 12]
+
+    syncer.sync()
+
+    assert len(fake_datalab.items["101"]["files"]) == 2
+    assert sorted(fake_cheminventory.downloaded_files) == [11, 12]
+
+
+def test_lookups_are_cached_within_a_sync(syncer, fake_cheminventory, fake_datalab):
+    for item_id in ("mp_0001", "mp_0002", "mp_0003"):
+        fake_datalab.seed_item(
+            item_id,
+            name="Novel electrolyte",
+            location="Example > FIHM Group > 4_007 > Glovebox",
+        )
+
+    syncer.sync()
+
+    assert len(fake_cheminventory.added_containers) == 3
+    assert fake_cheminventory.calls_to("/container/getsubstance") == 1
+    assert fake_cheminventory.calls_to("/location/load") == 1
+    assert fake_cheminventory.calls_to("/inventorymanagement/deletedcontainers/get") == 1
+    assert fake_datalab.clients_opened == 1
+    assert fake_datalab.items_listed == 1
+    # all new containers are added in a single batch
+    assert fake_cheminventory.calls_to("/container/add") == 1
+    # once for the initial lookup and once more after creating the DataLab ID field
+    assert fake_cheminventory.calls_to("/customfields/get") == 2
+
+
+def test_linked_files_not_listed_for_containers_disposed_in_datalab(
+    fake_cheminventory, fake_datalab
+):
+    from datalab_cheminventory_plugin import ChemInventoryDatalabSyncer
+
+    fake_cheminventory.add_row(id=101, name="Lithium foil", substanceid=9001)
+    syncer = ChemInventoryDatalabSyncer()
+    syncer.sync()
+    assert fake_cheminventory.calls_to("/filestore/getlinkedfiles") == 1
+
+    fake_datalab.items["101"]["status"] = "disposed"
+    syncer.sync()
+
+    assert fake_cheminventory.rows == []
+    assert fake_cheminventory.calls_to("/filestore/getlinkedfiles") == 1
+
+
+def test_serial_sync_matches_concurrent_sync(fake_cheminventory, fake_datalab):
+    from datalab_cheminventory_plugin import ChemInventoryDatalabSyncer
+
+    for row_id in range(101, 121):
+        fake_cheminventory.add_row(id=row_id, name=f"Container {row_id}")
+
+    ChemInventoryDatalabSyncer(skip_files=True, max_workers=1).sync()
+    serial = copy.deepcopy(fake_datalab.items)
+    fake_datalab.items.clear()
+
+    ChemInventoryDatalabSyncer(skip_files=True, max_workers=8).sync()
+
+    assert set(fake_datalab.items) == set(serial)
+    for item_id, item in fake_datalab.items.items():
+        assert {k: v for k, v in item.items() if k != "refcode"} == {
+            k: v for k, v in serial[item_id].items() if k != "refcode"
+        }
+
+
+def test_downloads_outside_a_sync_are_removed_on_close(fake_cheminventory, fake_datalab):
+    from datalab_cheminventory_plugin import ChemInventoryDatalabSyncer
+
+    with ChemInventoryDatalabSyncer() as syncer:
+        paths = syncer.download_files([11, 12])
+        assert [p.name for p in paths] == ["11.pdf", "12.pdf"]
+        assert all(p.parent == syncer.files_dir for p in paths)
+        files_dir = syncer.files_dir
+
+    assert not files_dir.exists()
+    assert syncer.cheminventory._session is None
+
+
+def test_existing_items_are_updated_without_attempting_creation(
+    syncer, fake_cheminventory, fake_datalab
+):
+    fake_cheminventory.add_row(id=101, name="Lithium foil")
+
+    syncer.sync()
+    assert fake_datalab.create_attempts == 1
+
+    fake_cheminventory.rows[0]["comments"] = "Stored under argon"
+    syncer.sync()
+
+    assert fake_datalab.create_attempts == 1
+    assert fake_datalab.items["101"]["description"] == "Stored under argon"
+
+
+def test_failed_file_download_is_not_uploaded(fake_cheminventory, fake_datalab, capsys):
+    from datalab_cheminventory_plugin import ChemInventoryDatalabSyncer
+
+    fake_cheminventory.add_row(id=101, name="Lithium foil", substanceid=9001)
+    fake_cheminventory.linked_files[9001] = [
+        {"id": 11, "mimetype": "application/pdf"},
+        {"id": 12, "mimetype": "application/pdf"},
+    ]
+    fake_cheminventory.missing_files.add(12)
+    syncer = ChemInventoryDatalabSyncer()
+
+    syncer.sync()
+
+    assert fake_datalab.items["101"]["files"] == []
+    # The item was still created; only attaching its files failed
+    output = capsys.readouterr().out
+    assert "Created 1 items." in output
+    assert "Failed to create" not in output
+    assert "Failed to attach files to 1 items." in output
+
+    fake_cheminventory.missing_files.clear()
+    syncer.sync()
+
+    assert sorted(f["original_name"] for f in fake_datalab.items["101"]["files"]) == [
+        "11.pdf",
+        "12.pdf",
+    ]
+
+
+def test_new_collection_is_created_once_for_concurrent_rows(fake_cheminventory, fake_datalab):
+    from datalab_cheminventory_plugin import ChemInventoryDatalabSyncer
+
+    for row_id in range(101, 111):
+        fake_cheminventory.add_row(id=row_id, name=f"Container {row_id}")
+    syncer = ChemInventoryDatalabSyncer(skip_files=True, max_workers=8)
+
+    syncer.sync_to_datalab(collection_id="cheminventory", dry_run=False)
+
+    assert list(fake_datalab.collections) == ["cheminventory"]
+    immutable_id = fake_datalab.collections["cheminventory"]["immutable_id"]
+    for row_id in range(101, 111):
+        assert fake_datalab.items[str(row_id)]["collections"] == [{"immutable_id": immutable_id}]
+
+
+def test_rows_resolving_to_the_same_item_attach_files_once(fake_cheminventory, fake_datalab):
+    from datalab_cheminventory_plugin import ChemInventoryDatalabSyncer
+
+    fake_datalab.seed_item("mp_0001", name="Lithium foil")
+    for row_id in (101, 102):
+        fake_cheminventory.add_row(
+            id=row_id, name="Lithium foil", barcode="mp_0001", substanceid=9001
+        )
+    fake_cheminventory.linked_files[9001] = [{"id": 11, "mimetype": "application/pdf"}]
+    syncer = ChemInventoryDatalabSyncer(max_workers=8)
+
+    syncer.sync()
+
+    assert [f["original_name"] for f in fake_datalab.items["mp_0001"]["files"]] == ["11.pdf"]
+    assert fake_cheminventory.downloaded_files == [11]
@@ -24,3 +24,180 @@ def test_location_resolver(mocked_cheminventory_api):
     assert syncer.get_location_id("FIHM Group > FIHM Group > Nottingham") == 932359
     with pytest.raises(ValueError, match="No location.*"):
         syncer.get_location_id("FIHM Group > 4_007 > Chemical Cupboard")
+
+
+def test_api_reuses_session_until_closed(mocked_cheminventory_api):
+    from datalab_cheminventory_plugin._api import ChemInventoryAPI
+
+    with ChemInventoryAPI() as api:
+        session = api.session
+        api.post("/general/getdetails")
+        api.post("/location/load")
+        assert api.session is session
+        assert api.download_session is not session
+
+    assert api._session is None
+    assert api._download_session is None
+
+
+def test_map_inventory_custom_fields():
+    from datalab_cheminventory_plugin import ChemInventoryDatalabSyncer
+
+    syncer = ChemInventoryDatalabSyncer.__new__(ChemInventoryDatalabSyncer)
+    custom_fields = {"DataLab ID": "cf-1", "Lot Number": "cf-2", "Form type": "sf-3"}
+    row = {
+        "id": 101,
+        "barcode": "",
+        "name": "Lithium foil",
+        "size": "100",
+        "unit": "g",
+        "supplier": "",
+        "cas": "7439-93-2",
+        "hcodes": None,
+        "smiles": "",
+        "molecularformula": "",
+        "molecularweight": "",
+        "location": "Example > FIHM Group",
+        "dateacquired": "",
+        "comments": "Opened",
+        "disposed": "0",
+        "cf-1": "test:QQ0001",
+        "cf-2": "LOT-42",
+        "sf-3": "",
+    }
+
+    (entry,) = syncer.map_inventory([row], custom_fields=custom_fields)
+
+    assert entry == syncer.map_inventory_row(row, custom_fields=custom_fields)
+    assert entry["item_id"] == "101"
+    assert entry["barcode"] is None
+    assert entry["refcode"] == "test:QQ0001"
+    assert entry["description"] == "Opened\nLot number: LOT-42"
+    assert entry["status"] == "available"
+
+
+def test_api_retries_transient_failures(mocked_cheminventory_api):
+    from httpx import Response
+
+    from datalab_cheminventory_plugin._api import ChemInventoryAPI
+
+    route = mocked_cheminventory_api.post("/inventorymanagement/export")
+    route.side_effect = [
+        Response(503),
+        Response(200, json={"status": "success", "data": {"rows": []}}),
+    ]
+
+    api = ChemInventoryAPI()
+    api.retry_backoff = 0
+    assert api.get_inventory() == []
+    assert route.call_count == 2
+
+
+def test_api_only_retries_errors_after_connecting(mocked_cheminventory_api):
+    import httpx
+
+    from datalab_cheminventory_plugin._api import ChemInventoryAPI
+
+    route = mocked_cheminventory_api.post("/inventorymanagement/export")
+    route.side_effect = [
+        httpx.ReadTimeout("timed out"),
+        httpx.Response(200, json={"status": "success", "data": {"rows": []}}),
+    ]
+
+    api = ChemInventoryAPI()
+    api.retry_backoff = 0
+    assert api.get_inventory() == []
+    assert route.call_count == 2
+
+    # Connection failures are left to the transport's own retries
+    route.side_effect = httpx.ConnectError("connection refused")
+    with pytest.raises(httpx.ConnectError):
+        api.get_inventory()
+    assert route.call_count == 3
+
+
+def test_api_does_not_retry_container_creation(mocked_cheminventory_api):
+    from httpx import Response
+
+    from datalab_cheminventory_plugin._api import ChemInventoryAPI
+
+    route = mocked_cheminventory_api.post("/container/add")
+    route.return_value = Response(503)
+
+    api = ChemInventoryAPI()
+    api.retry_backoff = 0
+    with pytest.raises(RuntimeError, match="Bad response"):
+        api.post("/container/add", body={"data": []})
+    assert route.call_count == 1
+
+
+def test_bounded_map_limits_calls_in_flight():
+    import concurrent.futures
+    import threading
+
+    from datalab_cheminventory_plugin import _bounded_map
+
+    lock = threading.Lock()
+    # Calls block until the bound is reached, so they really are in flight together
+    bound_reached = threading.Event()
+    in_flight = 0
+    peak = 0
+
+    def work(x):
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+            if in_flight == 3:
+                bound_reached.set()
+        bound_reached.wait(timeout=5)
+        with lock:
+            in_flight -= 1
+        return x * x
+
+    submitted = []
+
+    def args():
+        for x in range(50):
+            submitted.append(x)
+            yield x
+
+    # More workers than the bound, so only `_bounded_map` limits the calls in flight
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        results = _bounded_map(pool, work, args(), buffersize=3)
+        assert next(results) == 0
+        assert len(submitted) <= 4
+        assert list(results) == [x * x for x in range(1, 50)]
+
+    # The bound is reached, but never exceeded
+    assert bound_reached.is_set()
+    assert peak == 3
+
+
+def test_api_auth_body_follows_inventory_number(mock_environ):
+    from datalab_cheminventory_plugin._api import ChemInventoryAPI
+
+    api = ChemInventoryAPI(inventory_number=5)
+    assert api.auth_body == {"authtoken": api.auth_token, "inventory": 5}
+    api.inventory_number = None
+    assert api.auth_body == {"authtoken": api.auth_token}
+
+
+def test_api_sessions_are_created_once_across_threads(mock_environ):
+    import concurrent.futures
+    import threading
+
+    from datalab_cheminventory_plugin._api import ChemInventoryAPI
+
+    barrier = threading.Barrier(16)
+
+    def get_sessions(_):
+        barrier.wait(timeout=5)
+        return api.session, api.download_session
+
+    with ChemInventoryAPI() as api:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+            sessions = list(pool.map(get_sessions, range(16)))
+
+        assert {id(s) for s, _ in sessions} == {id(api.session)}
+        assert {id(d) for _, d in sessions} == {id(api.download_session)}